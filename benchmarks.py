@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+BENCHMARKS DEL GENERADOR DE MAPAS
+---------------------------------------------------------
+Mediciones reproducibles contra un WFS simulado en local, sin tocar
+el Catastro real.
+
+Uso: python benchmarks.py [memoria|arranque|latencia]
+"""
+
+import csv
+import math
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from array import array
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import script
+
+DIRECTORIO = Path(__file__).resolve().parent
+
+GML_SIMULADO = (
+    '<?xml version="1.0" encoding="UTF-8"?>'
+    '<r xmlns:gml="http://www.opengis.net/gml/3.2" '
+    'xmlns:cp="http://inspire.ec.europa.eu/schemas/cp/4.0" '
+    'xmlns:gn="http://inspire.ec.europa.eu/schemas/gn/4.0">'
+    '<cp:areaValue>1234.5</cp:areaValue><gn:text>Lugo</gn:text>'
+    '<gml:posList>42.0 -8.0 42.0 -8.001 42.001 -8.001 42.0 -8.0</gml:posList></r>'
+).encode('utf-8')
+
+class WFSSimulado:
+    """WFS local que responde siempre la misma parcela tras `retardo()` segundos."""
+
+    def __init__(self, retardo=None):
+        retardo = retardo or (lambda: 0)
+
+        class Manejador(BaseHTTPRequestHandler):
+            def do_GET(self):
+                time.sleep(retardo())
+                try:
+                    self.send_response(200)
+                    self.send_header("Content-Type", "text/xml")
+                    self.send_header("Content-Length", str(len(GML_SIMULADO)))
+                    self.end_headers()
+                    self.wfile.write(GML_SIMULADO)
+                except OSError:
+                    pass
+
+            def log_message(self, *args):
+                pass
+
+        class Servidor(ThreadingHTTPServer):
+            # Cola de escucha amplia: con la de 5 por defecto se pierden SYN y aparecen esperas de 1s
+            request_queue_size = 128
+
+        self.servidor = Servidor(("127.0.0.1", 0), Manejador)
+        self.servidor.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.servidor.server_port}/"
+
+    def __enter__(self):
+        threading.Thread(target=self.servidor.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.servidor.shutdown()
+        self.servidor.server_close()
+
+def escribir_csv(ruta, parcelas):
+    with open(ruta, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(["referencia", "tipo", "nombre", "color"])
+        for i in range(parcelas):
+            writer.writerow([f"{i:014d}AB0001XY", "Rústica", f"Finca {i}", "#2ecc71"])
+
+def medir_arranque(repeticiones=5, parcelas=500):
+    """Arranque en frío (intérprete nuevo) hasta leer el CSV y completar la primera petición."""
+
+    def cronometrar(codigo):
+        tiempos = []
+        for _ in range(repeticiones):
+            t0 = time.perf_counter()
+            proc = subprocess.run([sys.executable, "-c", codigo], cwd=DIRECTORIO,
+                                  capture_output=True)
+            tiempos.append(time.perf_counter() - t0)
+            if proc.returncode != 0:
+                return None
+        return statistics.median(tiempos)
+
+    with tempfile.TemporaryDirectory() as tmp, WFSSimulado() as wfs:
+        ruta = str(Path(tmp, "fincas.csv"))
+        escribir_csv(ruta, parcelas)
+        casos = [
+            ("Intérprete vacío", "pass"),
+            ("import script", "import script"),
+            (f"Lectura CSV de {parcelas} filas (sin pandas)",
+             f"import script; list(script.leer_csv({ruta!r}))"),
+            ("Primera petición completada",
+             f"import script; filas = list(script.leer_csv({ruta!r})); "
+             f"script.peticion_cubierta({wfs.url!r}, {{}})"),
+            ("Referencia: import pandas", "import pandas"),
+        ]
+        print(f"Arranque en frío (mediana de {repeticiones}):")
+        for nombre, codigo in casos:
+            t = cronometrar(codigo)
+            valor = f"{t * 1000:.0f} ms" if t is not None else "no disponible"
+            print(f"   - {nombre}: {valor}")
+
+def comparar_memoria(n_parcelas=2000, n_vertices=60):
+    """Compara la memoria de Parcela frente a los Feature dict-de-listas de antes."""
+
+    def medir(construir):
+        tracemalloc.start()
+        objetos = construir()
+        actual, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del objetos
+        return actual
+
+    def coords_lista(i):
+        return [[-8.0 + i * 1e-4 + v * 1e-6, 42.0 + v * 1e-6] for v in range(n_vertices)]
+
+    def como_dicts():
+        return [{
+            "type": "Feature",
+            "properties": {
+                "ref": f"{i:014d}AB0001XY", "tipo": "Rústica", "nombre": f"Finca {i}",
+                "color": "#2ecc71", "area_m2": 1234.5, "municipio": "Lugo"
+            },
+            "geometry": {"type": "Polygon", "coordinates": [coords_lista(i)]}
+        } for i in range(n_parcelas)]
+
+    def como_parcelas():
+        return [script.Parcela(
+            f"{i:014d}AB0001XY", "Rústica", f"Finca {i}", "#2ecc71", 1234.5, "Lugo",
+            array('d', (x for par in coords_lista(i) for x in par))
+        ) for i in range(n_parcelas)]
+
+    bytes_dicts = medir(como_dicts)
+    bytes_parcelas = medir(como_parcelas)
+    print(f"Parcelas: {n_parcelas} x {n_vertices} vértices")
+    print(f"   - Feature dict/listas: {bytes_dicts / 1e6:.1f} MB")
+    print(f"   - Parcela + array('d'): {bytes_parcelas / 1e6:.1f} MB")
+    print(f"   - Ahorro: {(1 - bytes_parcelas / bytes_dicts) * 100:.0f}%")
+    return bytes_dicts, bytes_parcelas
+
+def percentil(datos, p):
+    datos = sorted(datos)
+    return datos[max(0, math.ceil(p / 100 * len(datos)) - 1)]
+
+def medir_cola_latencia(ejecuciones=100, parcelas=20, semilla=7, plazo_total=0.3):
+    """p50/p99 del tiempo de ejecución con y sin copias contra un WFS con jitter."""
+    azar = random.Random(semilla)
+    lock_azar = threading.Lock()
+
+    def retardo():
+        # 90% rápidas, 8% lentas, 2% atascadas
+        with lock_azar:
+            r = azar.random()
+            return (azar.uniform(0.01, 0.04) if r < 0.90 else
+                    azar.uniform(0.1, 0.25) if r < 0.98 else 1.5)
+
+    filas = [{'referencia': f"{i:014d}", 'tipo': 'R', 'nombre': f"F{i}", 'color': '#fff'}
+             for i in range(parcelas)]
+    # Los modos con copias comparten el estimador entre ejecuciones, como el servidor
+    modos = (
+        ("Sin copias (TIMEOUT fijo)", 0, math.inf, None),
+        ("Con copias a p95 + plazo p99", script.MAX_COPIAS, script.MIN_MUESTRAS, None),
+        (f"Con copias + plazo total {plazo_total}s", script.MAX_COPIAS, script.MIN_MUESTRAS,
+         plazo_total),
+    )
+    print(f"WFS local con jitter: {ejecuciones} ejecuciones x {parcelas} parcelas")
+    with WFSSimulado(retardo) as wfs:
+        for nombre, copias, min_muestras, plazo in modos:
+            latencias = script.LatenciasCatastro(min_muestras=min_muestras)
+            tiempos = []
+            sin_tiempo = 0
+            for _ in range(ejecuciones):
+                t0 = time.perf_counter()
+                _, errores = script.procesar_filas(filas, url=wfs.url, latencias=latencias,
+                                                   max_copias=copias, plazo_total=plazo)
+                tiempos.append(time.perf_counter() - t0)
+                sin_tiempo += sum(e.motivo == "Plazo total agotado" for e in errores)
+            print(f"   - {nombre}: p50 {percentil(tiempos, 50):.2f}s · "
+                  f"p99 {percentil(tiempos, 99):.2f}s · "
+                  f"copias {latencias.tasa_copias():.1%} de {latencias.peticiones} peticiones"
+                  + (f" · {sin_tiempo} parcelas sin tiempo" if plazo else ""))
+    comprobar_salida()
+
+def comprobar_salida(atasco=15, parcelas=20):
+    """Tiempo hasta que el proceso termina cuando una petición se queda colgada."""
+    primera = threading.Event()
+
+    def retardo():
+        if not primera.is_set():
+            primera.set()
+            return atasco
+        return 0.02
+
+    with WFSSimulado(retardo) as wfs:
+        codigo = (
+            "import script, time\n"
+            f"filas = [{{'referencia': str(i), 'tipo': 'R', 'nombre': 'F', 'color': '#fff'}} "
+            f"for i in range({parcelas})]\n"
+            "t0 = time.perf_counter()\n"
+            f"script.procesar_filas(filas, url={wfs.url!r})\n"
+            "print(time.perf_counter() - t0)\n"
+        )
+        t0 = time.perf_counter()
+        proc = subprocess.run([sys.executable, "-c", codigo], cwd=DIRECTORIO,
+                              capture_output=True, text=True)
+        total = time.perf_counter() - t0
+    if proc.returncode != 0:
+        print(f"   - Salida con una petición atascada {atasco}s: no disponible")
+        return
+    print(f"   - Una petición atascada {atasco}s: procesar_filas {float(proc.stdout):.2f}s · "
+          f"proceso completo {total:.2f}s")
+
+BENCHMARKS = {
+    "memoria": comparar_memoria,
+    "arranque": medir_arranque,
+    "latencia": medir_cola_latencia,
+}
+
+if __name__ == "__main__":
+    nombre = sys.argv[1] if len(sys.argv) > 1 else ""
+    if nombre not in BENCHMARKS:
+        print(f"Uso: python benchmarks.py [{'|'.join(BENCHMARKS)}]")
+        sys.exit(1)
+    BENCHMARKS[nombre]()
@@ -7,11 +7,16 @@ Autor: Tu Asistente de IA
 Mejoras: Totalmente responsive para móvil con panel inferior deslizable
 """
 
-import pandas as pd
-import requests
+import csv
 import json
+import math
+import queue
+import socket
+import threading
 import xml.etree.ElementTree as ET
+from array import array
 from pathlib import Path
+from collections import deque
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 import time
@@ -21,22 +26,426 @@ import sys
 MAX_WORKERS = 20
 TIMEOUT = 30
 MAX_RETRIES = 3
+URL_WFS = "http://ovc.catastro.meh.es/INSPIRE/wfsCP.aspx"
+
+# --- CONTROL DE LATENCIA (peticiones cubiertas) ---
+# Plazo por petición = p99 observado x FACTOR_PLAZO (entre PLAZO_MINIMO y TIMEOUT).
+# Si una petición supera el p95 se lanza una copia; gana la primera respuesta.
+# PLAZO_TOTAL: segundos máximos de una ejecución completa (CLI y servidor).
+PLAZO_TOTAL = 300
+FACTOR_PLAZO = 3
+PLAZO_MINIMO = 2
+MAX_COPIAS = 1
+MIN_MUESTRAS = 10
+VENTANA_LATENCIAS = 200
+
+COLUMNAS = ['referencia', 'tipo', 'nombre', 'color']
+
+# --- NIVEL DE DETALLE DEL MAPA ---
+# Por debajo de ZOOM_POLIGONOS se dibujan clusters de centroides.
+# NIVELES_LOD: zoom mínimo -> tolerancia de simplificación (grados, ~1 px).
+ZOOM_POLIGONOS = 14
+NIVELES_LOD = {14: 8e-5, 16: 2e-5}
+ZOOM_COMPLETO = 18
+
+class Parcela:
+    """Registro compacto de una parcela.
+
+    Las coordenadas se guardan planas en un array('d') (lon, lat, lon, lat...)
+    y sólo se expanden a GeoJSON al escribir el HTML.
+    """
+    __slots__ = ('ref', 'tipo', 'nombre', 'color', 'area_m2', 'municipio', 'coords')
+
+    def __init__(self, ref, tipo, nombre, color, area_m2, municipio, coords):
+        self.ref = ref
+        self.tipo = tipo
+        self.nombre = nombre
+        self.color = color
+        self.area_m2 = area_m2
+        self.municipio = municipio
+        self.coords = coords
+
+    def propiedades(self):
+        return {
+            "ref": self.ref,
+            "tipo": self.tipo,
+            "nombre": self.nombre,
+            "color": self.color,
+            "area_m2": self.area_m2,
+            "municipio": self.municipio
+        }
+
+    def bbox(self):
+        c = self.coords
+        lons, lats = c[0::2], c[1::2]
+        return [min(lons), min(lats), max(lons), max(lats)]
+
+    def centroide(self):
+        """Centroide del polígono (fórmula del área), en lon/lat."""
+        c = self.coords
+        n = len(c) // 2
+        x0, y0 = c[0], c[1]
+        a = cx = cy = 0.0
+        for i in range(n):
+            j = (i + 1) % n
+            xi, yi = c[2*i] - x0, c[2*i+1] - y0
+            xj, yj = c[2*j] - x0, c[2*j+1] - y0
+            cruz = xi * yj - xj * yi
+            a += cruz
+            cx += (xi + xj) * cruz
+            cy += (yi + yj) * cruz
+        if a == 0:
+            return [sum(c[0::2]) / n, sum(c[1::2]) / n]
+        return [x0 + cx / (3 * a), y0 + cy / (3 * a)]
+
+    def niveles_detalle(self):
+        """Geometrías simplificadas por zoom mínimo (sólo las que ahorran vértices)."""
+        niveles = {}
+        for zoom, tolerancia in sorted(NIVELES_LOD.items()):
+            simplificada = simplificar_anillo(self.coords, tolerancia)
+            if simplificada is not None:
+                niveles[zoom] = simplificada
+        return niveles
+
+    def a_json(self):
+        # Serializa directamente desde el array, sin crear listas intermedias
+        props = json.dumps(self.propiedades(), ensure_ascii=False)
+        lod = ", ".join(f'"{z}": {_anillo_json(r)}' for z, r in self.niveles_detalle().items())
+        return ('{"type": "Feature", "bbox": ' + json.dumps(self.bbox()) +
+                ', "centro": ' + json.dumps(self.centroide()) +
+                ', "lod": {' + lod + '}, "properties": ' + props +
+                ', "geometry": {"type": "Polygon", "coordinates": [' +
+                _anillo_json(self.coords) + ']}}')
+
+def _vertices(coords):
+    for i in range(0, len(coords), 2):
+        yield coords[i], coords[i+1]
+
+def _anillo_json(coords):
+    return "[" + ",".join(f"[{lon!r},{lat!r}]" for lon, lat in _vertices(coords)) + "]"
+
+def simplificar_anillo(coords, tolerancia):
+    """Douglas-Peucker sobre un anillo plano lon/lat.
+
+    Devuelve None si no elimina vértices o si el anillo degeneraría.
+    """
+    n = len(coords) // 2
+    if n <= 4:
+        return None
+    conservar = bytearray(n)
+    conservar[0] = conservar[n-1] = 1
+    tol2 = tolerancia * tolerancia
+    pila = [(0, n - 1)]
+    while pila:
+        ini, fin = pila.pop()
+        ax, ay = coords[2*ini], coords[2*ini+1]
+        dx, dy = coords[2*fin] - ax, coords[2*fin+1] - ay
+        l2 = dx * dx + dy * dy
+        max_d, idx = 0.0, -1
+        for i in range(ini + 1, fin):
+            px, py = coords[2*i] - ax, coords[2*i+1] - ay
+            if l2 > 0:
+                t = max(0.0, min(1.0, (px * dx + py * dy) / l2))
+                px, py = px - t * dx, py - t * dy
+            d = px * px + py * py
+            if d > max_d:
+                max_d, idx = d, i
+        if max_d > tol2:
+            conservar[idx] = 1
+            pila.append((ini, idx))
+            pila.append((idx, fin))
+    total = sum(conservar)
+    if total < 4 or total == n:
+        return None
+    resultado = array('d')
+    for i in range(n):
+        if conservar[i]:
+            resultado.append(coords[2*i])
+            resultado.append(coords[2*i+1])
+    return resultado
+
+def parcelas_a_geojson(parcelas):
+    """Expande la lista de Parcela a un FeatureCollection en texto JSON."""
+    return ('{"type": "FeatureCollection", "features": [' +
+            ", ".join(p.a_json() for p in parcelas) + ']}')
 
 def limpiar_consola():
     print("\033[H\033[J", end="")
 
-def validar_excel(df):
-    errores = []
-    df.columns = [c.strip().lower() for c in df.columns]
-    required_cols = ['referencia', 'tipo', 'nombre', 'color']
-    missing = [c for c in required_cols if c not in df.columns]
+def validar_columnas(columnas):
+    missing = [c for c in COLUMNAS if c not in columnas]
     if missing:
         return False, f"Faltan las columnas: {', '.join(missing)}"
     return True, "Estructura correcta"
 
-def obtener_geometria_catastro(referencia_catastral, nombre_log=""):
+def validar_excel(df):
+    df.columns = [str(c).strip().lower() for c in df.columns]
+    return validar_columnas(df.columns)
+
+def leer_csv(ruta):
+    """Lector CSV en streaming sin pandas. Sólo conserva las columnas necesarias."""
+    with open(ruta, newline='', encoding='utf-8-sig') as f:
+        reader = csv.reader(f)
+        cabecera = [c.strip().lower() for c in next(reader, [])]
+        ok, msg = validar_columnas(cabecera)
+        if not ok:
+            raise ValueError(msg)
+        indices = [(c, cabecera.index(c)) for c in COLUMNAS]
+        for fila in reader:
+            if not any(fila):
+                continue
+            yield {c: fila[i] if i < len(fila) else '' for c, i in indices}
+
+def leer_excel(ruta):
+    # pandas (y su motor openpyxl) sólo se cargan si la entrada es Excel
+    import pandas as pd
+    df = pd.read_excel(ruta)
+    ok, msg = validar_excel(df)
+    if not ok:
+        raise ValueError(msg)
+    return df[COLUMNAS].to_dict('records')
+
+def leer_filas(ruta):
+    if str(ruta).endswith('.csv'):
+        return list(leer_csv(ruta))
+    return leer_excel(ruta)
+
+class LatenciasCatastro:
+    """Ventana de latencias recientes del WFS para derivar plazos y copias."""
+
+    def __init__(self, ventana=VENTANA_LATENCIAS, min_muestras=MIN_MUESTRAS):
+        self.min_muestras = min_muestras
+        self._muestras = deque(maxlen=ventana)
+        self._lock = threading.Lock()
+        self.peticiones = 0
+        self.copias = 0
+
+    def registrar(self, segundos):
+        with self._lock:
+            self._muestras.append(segundos)
+
+    def contar(self, copias):
+        with self._lock:
+            self.peticiones += 1
+            self.copias += copias
+
+    def tasa_copias(self):
+        with self._lock:
+            return self.copias / self.peticiones if self.peticiones else 0.0
+
+    def percentil(self, p):
+        with self._lock:
+            datos = sorted(self._muestras)
+        if not datos or len(datos) < self.min_muestras:
+            return None
+        return datos[max(0, math.ceil(p / 100 * len(datos)) - 1)]
+
+    def plazo(self):
+        p99 = self.percentil(99)
+        if p99 is None:
+            return TIMEOUT
+        return min(TIMEOUT, max(PLAZO_MINIMO, p99 * FACTOR_PLAZO))
+
+    def umbral_copia(self):
+        return self.percentil(95)
+
+LATENCIAS = LatenciasCatastro()
+
+class PlazoAgotado(Exception):
+    """Se acabó el plazo total de la ejecución (no es un fallo de red)."""
+
+class CancelacionNoDisponible(RuntimeError):
+    """La conexión no registró su socket: no se podrían cancelar las copias."""
+
+_clases_cancelables = None
+
+def _sesion_cancelable(sockets):
+    """Sesión de requests que apunta en `sockets` cada socket que abre.
+
+    Cerrar la sesión no desbloquea un hilo que espera respuesta; hacer
+    shutdown() del socket sí. Se apoya en las clases de conexión de urllib3
+    (versión fijada en requirments.txt) y funciona con conexión directa y con
+    proxy HTTP(S); los proxies SOCKS no están soportados.
+    """
+    global _clases_cancelables
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.connection import HTTPConnection, HTTPSConnection
+    from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+    if _clases_cancelables is None:
+        def con_registro(base):
+            class Conexion(base):
+                def connect(self):
+                    super().connect()
+                    self.registro_sockets.append(self.sock)
+            return Conexion
+
+        class Adaptador(HTTPAdapter):
+            def __init__(self, sockets):
+                self.sockets = sockets
+                super().__init__(max_retries=0)
+
+            def _con_registro(self, manager):
+                pools = {}
+                for esquema, pool, conexion in (('http', HTTPConnectionPool, HTTPConnection),
+                                                ('https', HTTPSConnectionPool, HTTPSConnection)):
+                    clase = type('Conexion', (con_registro(conexion),),
+                                 {'registro_sockets': self.sockets})
+                    pools[esquema] = type('Pool', (pool,), {'ConnectionCls': clase})
+                manager.pool_classes_by_scheme = pools
+                return manager
+
+            def init_poolmanager(self, *args, **kwargs):
+                super().init_poolmanager(*args, **kwargs)
+                self._con_registro(self.poolmanager)
+
+            def proxy_manager_for(self, proxy, **proxy_kwargs):
+                nuevo = proxy not in self.proxy_manager
+                manager = super().proxy_manager_for(proxy, **proxy_kwargs)
+                # SOCKS usa sus propias clases de conexión: se deja tal cual y
+                # la comprobación de _Intento.run avisa de que no se puede cancelar
+                if nuevo and not proxy.lower().startswith("socks"):
+                    self._con_registro(manager)
+                return manager
+
+        _clases_cancelables = Adaptador
+
+    sesion = requests.Session()
+    adaptador = _clases_cancelables(sockets)
+    sesion.mount('http://', adaptador)
+    sesion.mount('https://', adaptador)
+    return sesion
+
+class _Intento(threading.Thread):
+    """Una petición GET en un hilo daemon con su propia sesión.
+
+    Deja (intento, contenido, error) en `resultados`. cancelar()
+    corta el socket, así que la salida del intérprete nunca espera a un perdedor.
+    """
+
+    def __init__(self, url, params, plazo, resultados):
+        super().__init__(daemon=True, name="catastro")
+        self.url, self.params, self.plazo = url, params, plazo
+        self.resultados = resultados
+        self.cancelado = False
+        self.terminado = False
+        self.inicio = None
+        self.sockets = []
+        self.sesion = _sesion_cancelable(self.sockets)
+
+    def run(self):
+        try:
+            with self.sesion.get(self.url, params=self.params, timeout=self.plazo,
+                                 stream=True) as response:
+                if not self.sockets:
+                    raise CancelacionNoDisponible(
+                        "La conexión al Catastro no registró su socket; las copias no se "
+                        "podrían cancelar (¿proxy SOCKS o versión de urllib3 no soportada?)")
+                response.raise_for_status()
+                partes = []
+                for bloque in response.iter_content(65536):
+                    if self.cancelado:
+                        return
+                    partes.append(bloque)
+            self.resultados.put((self, b"".join(partes), None))
+        except Exception as e:
+            if not self.cancelado:
+                self.resultados.put((self, None, e))
+        finally:
+            self.sesion.close()
+
+    def cancelar(self):
+        self.cancelado = True
+        for sock in list(self.sockets):
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        self.sesion.close()
+
+def peticion_cubierta(url, params, limite=None, latencias=None, max_copias=MAX_COPIAS):
+    """GET con plazo adaptativo y copias (hedging); devuelve el cuerpo de la primera respuesta.
+
+    Cada intento corre en su propio hilo y sesión; al terminar se cancelan los
+    perdedores cortando su socket, incluso si aún esperan las cabeceras.
+    """
+    import requests
+    latencias = latencias or LATENCIAS
+    plazo = latencias.plazo()
+    recortado = False
+    if limite is not None:
+        restante = limite - time.monotonic()
+        if restante <= 0:
+            raise PlazoAgotado()
+        if restante < plazo:
+            plazo, recortado = restante, True
+
+    resultados = queue.Queue()
+    intentos = []
+
+    def lanzar():
+        intento = _Intento(url, params, plazo, resultados)
+        intentos.append(intento)
+        intento.inicio = time.monotonic()
+        intento.start()
+
+    inicio = ultimo_lanzamiento = time.monotonic()
+    fin = inicio + plazo
+    lanzar()
+    activos = 1
+    agotado = False
+    try:
+        while True:
+            ahora = time.monotonic()
+            if ahora >= fin:
+                if recortado:
+                    agotado = True
+                    raise PlazoAgotado()
+                raise requests.exceptions.Timeout(f"Sin respuesta en {plazo:.1f}s")
+            espera = fin - ahora
+            if len(intentos) <= max_copias:
+                # Al arrancar aún no hay muestras: se revisa el p95 periódicamente
+                umbral = latencias.umbral_copia()
+                proxima_copia = ultimo_lanzamiento + umbral if umbral is not None else ahora + 0.1
+                espera = min(espera, max(0, proxima_copia - ahora))
+            try:
+                intento, contenido, error = resultados.get(timeout=espera)
+            except queue.Empty:
+                pass
+            else:
+                intento.terminado = True
+                if isinstance(error, CancelacionNoDisponible):
+                    raise error
+                if error is None:
+                    # Latencia de la petición lógica, desde el primer intento
+                    latencias.registrar(time.monotonic() - inicio)
+                    return contenido
+                activos -= 1
+                if activos == 0:
+                    raise error
+            umbral = latencias.umbral_copia()
+            if (len(intentos) <= max_copias and umbral is not None
+                    and time.monotonic() >= ultimo_lanzamiento + umbral):
+                lanzar()
+                activos += 1
+                ultimo_lanzamiento = time.monotonic()
+    finally:
+        latencias.contar(len(intentos) - 1)
+        ahora = time.monotonic()
+        for intento in intentos:
+            if intento.terminado:
+                continue
+            intento.cancelar()
+            # Perdedor en vuelo: muestra censurada (tardaría al menos esto). Si
+            # el plazo total cortó la espera, la muestra no es representativa.
+            if not agotado:
+                latencias.registrar(ahora - intento.inicio)
+
+def obtener_geometria_catastro(referencia_catastral, nombre_log="", limite=None,
+                               url=URL_WFS, latencias=None, max_copias=MAX_COPIAS):
+    import requests
     ref_corta = referencia_catastral[:14]
-    url = "http://ovc.catastro.meh.es/INSPIRE/wfsCP.aspx"
     params = {
         'service': 'WFS', 'version': '2', 'request': 'GetFeature',
         'STOREDQUERIE_ID': 'GetParcel', 'refcat': ref_corta,
@@ -50,9 +459,7 @@ def obtener_geometria_catastro(referencia_catastral, nombre_log=""):
 
     for intento in range(MAX_RETRIES):
         try:
-            response = requests.get(url, params=params, timeout=TIMEOUT)
-            response.raise_for_status()
-            root = ET.fromstring(response.content)
+            root = ET.fromstring(peticion_cubierta(url, params, limite, latencias, max_copias))
             
             area_elem = root.find('.//cp:areaValue', ns)
             area_m2 = float(area_elem.text) if area_elem is not None else 0
@@ -65,17 +472,20 @@ def obtener_geometria_catastro(referencia_catastral, nombre_log=""):
             if pos_list is not None:
                 coords_text = pos_list.text.strip()
                 coords_array = coords_text.split()
-                coordinates = []
-                for i in range(0, len(coords_array), 2):
-                    lat = float(coords_array[i])
-                    lon = float(coords_array[i+1])
-                    coordinates.append([lon, lat])
+                # posList viene como lat lon; se guarda plano como lon lat
+                coordinates = array('d', map(float, coords_array))
+                coordinates[0::2], coordinates[1::2] = coordinates[1::2], coordinates[0::2]
                 return coordinates, area_m2, municipio, None
             else:
                 return None, 0, municipio, "Geometría no encontrada"
 
+        except PlazoAgotado:
+            return None, 0, "Sin tiempo", "Plazo total agotado"
+        except CancelacionNoDisponible:
+            raise
         except requests.exceptions.RequestException:
-            if intento < MAX_RETRIES - 1:
+            sin_tiempo = limite is not None and limite - time.monotonic() <= 1
+            if intento < MAX_RETRIES - 1 and not sin_tiempo:
                 time.sleep(1)
                 continue
             else:
@@ -85,32 +495,69 @@ def obtener_geometria_catastro(referencia_catastral, nombre_log=""):
             
     return None, 0, "Error", "Error desconocido"
 
-def procesar_fila(idx, row):
+# Errores de obtener_geometria_catastro que pueden resolverse reintentando
+ERRORES_TRANSITORIOS = {"Error Red", "Sin tiempo"}
+
+class ErrorParcela:
+    """Parcela no recuperada. `transitorio` indica si merece la pena reintentarla."""
+    __slots__ = ('ref', 'nombre', 'motivo', 'transitorio')
+
+    def __init__(self, ref, nombre, motivo, transitorio):
+        self.ref = ref
+        self.nombre = nombre
+        self.motivo = motivo
+        self.transitorio = transitorio
+
+    def __str__(self):
+        return f"{self.nombre} ({self.ref}): {self.motivo}"
+
+def procesar_fila(idx, row, cache=None, red=None):
     ref = str(row['referencia']).strip()
     nombre = str(row['nombre']).strip()
-    coords, area, muni, err = obtener_geometria_catastro(ref, nombre)
+    if cache is not None and ref in cache:
+        coords, area, muni = cache[ref]
+        err = None
+    else:
+        coords, area, muni, err = obtener_geometria_catastro(ref, nombre, **(red or {}))
+        if coords and cache is not None:
+            cache[ref] = (coords, area, muni)
     
     if coords:
-        return {
-            "type": "Feature",
-            "properties": {
-                "ref": ref,
-                "tipo": str(row['tipo']).strip(),
-                "nombre": nombre,
-                "color": str(row['color']).strip(),
-                "area_m2": area,
-                "municipio": muni
-            },
-            "geometry": {
-                "type": "Polygon",
-                "coordinates": [coords]
-            }
-        }, None
+        return Parcela(
+            ref, str(row['tipo']).strip(), nombre, str(row['color']).strip(),
+            area, muni, coords
+        ), None
     else:
-        return None, f"{nombre} ({ref}): {err}"
+        return None, ErrorParcela(ref, nombre, err, muni in ERRORES_TRANSITORIOS)
+
+def procesar_filas(filas, cache=None, al_completar=None, plazo_total=None,
+                   url=URL_WFS, latencias=None, max_copias=MAX_COPIAS):
+    """Descarga en paralelo y devuelve (parcelas, errores) en el orden de entrada.
+
+    plazo_total (segundos) limita la ejecución completa; por defecto no hay límite
+    (main() y el servidor pasan PLAZO_TOTAL).
+    """
+    red = {
+        'limite': time.monotonic() + plazo_total if plazo_total else None,
+        'url': url, 'latencias': latencias, 'max_copias': max_copias,
+    }
+    resultados = [None] * len(filas)
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = {executor.submit(procesar_fila, i, row, cache, red): i
+                   for i, row in enumerate(filas)}
+        
+        for future in as_completed(futures):
+            resultados[futures[future]] = future.result()
+            if al_completar:
+                al_completar()
+
+    features = [res for res, err in resultados if res]
+    errores = [err for res, err in resultados if not res]
+    return features, errores
 
-def generar_html_final(geojson_data, nombre_cliente, errores):
-    json_str = json.dumps(geojson_data, ensure_ascii=False)
+def generar_html_final(parcelas, nombre_cliente, errores):
+    json_str = parcelas_a_geojson(parcelas)
+    niveles_lod = json.dumps(sorted(NIVELES_LOD))
     fecha = datetime.now().strftime("%d/%m/%Y")
     
     html = f"""<!DOCTYPE html>
@@ -210,6 +657,18 @@ def generar_html_final(geojson_data, nombre_cliente, errores):
         .filter-btn-right {{ font-size: 12px; color: #888; font-weight: 600; }}
         .color-dot {{ display: inline-block; width: 12px; height: 12px; border-radius: 50%; margin-right: 10px; }}
         
+        /* Clusters de parcelas (zoom bajo) */
+        .cluster-icon {{ background: none; border: none; }}
+        .cluster-ring {{
+            display: flex; align-items: center; justify-content: center;
+            border-radius: 50%; box-shadow: 0 2px 8px rgba(0,0,0,0.35); cursor: pointer;
+        }}
+        .cluster-ring span {{
+            display: flex; align-items: center; justify-content: center;
+            width: 70%; height: 70%; border-radius: 50%; background: white;
+            font-size: 12px; font-weight: 700; color: #2c3e50;
+        }}
+        
         /* --- POPUP MEJORADO --- */
         .leaflet-popup-content-wrapper {{ border-radius: 8px; box-shadow: 0 3px 14px rgba(0,0,0,0.2); padding: 0; overflow: hidden; }}
         .leaflet-popup-content {{ margin: 0; width: 280px !important; }}
@@ -573,13 +1032,123 @@ def generar_html_final(geojson_data, nombre_cliente, errores):
         layer.bindPopup(popupContent, {{ maxWidth: 300 }});
     }}
 
+    // NIVEL DE DETALLE: clusters de centroides a zoom bajo, polígonos desde el umbral
+    const ZOOM_POLIGONOS = {ZOOM_POLIGONOS};
+    const ZOOM_COMPLETO = {ZOOM_COMPLETO};
+    const NIVELES_LOD = {niveles_lod};
+    const TAM_CELDA = 60;
+    
+    const coloresPorTipo = {{}};
+    data.features.forEach(f => {{
+        if (!coloresPorTipo[f.properties.tipo]) coloresPorTipo[f.properties.tipo] = f.properties.color;
+    }});
+    
+    const clusterLayer = L.layerGroup().addTo(map);
+    let seleccion = data.features;
+    let nivelActual = null;
+    
+    function boundsDe(feats) {{
+        let b = null;
+        feats.forEach(f => {{
+            const fb = L.latLngBounds([f.bbox[1], f.bbox[0]], [f.bbox[3], f.bbox[2]]);
+            b = b ? b.extend(fb) : fb;
+        }});
+        return b;
+    }}
+    
+    function nivelPara(zoom) {{
+        if (zoom >= ZOOM_COMPLETO || NIVELES_LOD.length === 0) return 'completo';
+        let nivel = String(NIVELES_LOD[0]);
+        NIVELES_LOD.forEach(z => {{ if (z <= zoom) nivel = String(z); }});
+        return nivel;
+    }}
+    
+    function conNivel(f, nivel) {{
+        const anillo = f.lod && f.lod[nivel];
+        if (!anillo) return f;
+        return {{ type: 'Feature', properties: f.properties, geometry: {{ type: 'Polygon', coordinates: [anillo] }} }};
+    }}
+    
+    function dibujarClusters() {{
+        clusterLayer.clearLayers();
+        const zoom = map.getZoom();
+        const celdas = new Map();
+        
+        // Agrupar centroides en una rejilla de píxeles: coste independiente de los vértices
+        seleccion.forEach(f => {{
+            const p = map.project([f.centro[1], f.centro[0]], zoom);
+            const clave = Math.floor(p.x / TAM_CELDA) + ':' + Math.floor(p.y / TAM_CELDA);
+            let c = celdas.get(clave);
+            if (!c) {{
+                c = {{ feats: [], lat: 0, lng: 0, tipos: {{}} }};
+                celdas.set(clave, c);
+            }}
+            c.feats.push(f);
+            c.lat += f.centro[1];
+            c.lng += f.centro[0];
+            c.tipos[f.properties.tipo] = (c.tipos[f.properties.tipo] || 0) + 1;
+        }});
+        
+        celdas.forEach(c => {{
+            const n = c.feats.length;
+            const tipos = Object.keys(c.tipos).sort();
+            let acumulado = 0;
+            const segmentos = tipos.map(t => {{
+                const ini = acumulado / n * 360;
+                acumulado += c.tipos[t];
+                return `${{coloresPorTipo[t]}} ${{ini}}deg ${{acumulado / n * 360}}deg`;
+            }}).join(', ');
+            const tam = n < 10 ? 34 : (n < 100 ? 42 : 50);
+            const icono = L.divIcon({{
+                className: 'cluster-icon',
+                html: `<div class="cluster-ring" style="width:${{tam}}px; height:${{tam}}px; background:conic-gradient(${{segmentos}})"><span>${{n}}</span></div>`,
+                iconSize: [tam, tam]
+            }});
+            const detalle = tipos.map(t =>
+                `<span class="color-dot" style="background:${{coloresPorTipo[t]}}"></span>${{t}}: <b>${{c.tipos[t]}}</b>`
+            ).join('<br>');
+            
+            L.marker([c.lat / n, c.lng / n], {{ icon: icono }})
+                .bindTooltip(detalle, {{ direction: 'top' }})
+                .on('click', () => map.fitBounds(boundsDe(c.feats), {{ padding: [50, 50], maxZoom: ZOOM_COMPLETO }}))
+                .addTo(clusterLayer);
+        }});
+    }}
+    
+    function render() {{
+        const zoom = map.getZoom();
+        if (zoom < ZOOM_POLIGONOS) {{
+            if (nivelActual !== 'cluster') {{
+                geoJsonLayer.clearLayers();
+                nivelActual = 'cluster';
+            }}
+            dibujarClusters();
+            return;
+        }}
+        clusterLayer.clearLayers();
+        const nivel = nivelPara(zoom);
+        if (nivel === nivelActual) return;
+        nivelActual = nivel;
+        geoJsonLayer.clearLayers();
+        geoJsonLayer.addData(seleccion.map(f => conNivel(f, nivel)));
+    }}
+    
+    function mostrar(feats) {{
+        seleccion = feats;
+        nivelActual = null;
+        const b = boundsDe(feats);
+        if (b) map.fitBounds(b, {{ padding: [50, 50] }});
+        render();
+    }}
+
     // CARGAR DATOS
-    geoJsonLayer = L.geoJSON(data, {{
+    geoJsonLayer = L.geoJSON(null, {{
         style: style,
         onEachFeature: onEachFeature
     }}).addTo(map);
-
-    if (data.features.length > 0) map.fitBounds(geoJsonLayer.getBounds(), {{ padding: [50, 50] }});
+    
+    map.on('zoomend', render);
+    mostrar(data.features);
 
     // --- LÓGICA DE NEGOCIO ---
     
@@ -612,16 +1181,12 @@ def generar_html_final(geojson_data, nombre_cliente, errores):
         </div>
         <span class="filter-btn-right">${{formatArea(totalArea)}}</span>
     `;
-    btnAll.onclick = () => {{ 
-        geoJsonLayer.clearLayers(); 
-        geoJsonLayer.addData(data); 
-        map.fitBounds(geoJsonLayer.getBounds()); 
-    }};
+    btnAll.onclick = () => mostrar(data.features);
     container.appendChild(btnAll);
 
     types.forEach(type => {{
         const feats = data.features.filter(f => f.properties.tipo === type);
-        const color = feats[0].properties.color;
+        const color = coloresPorTipo[type];
         const areaTotal = areasPorTipo[type];
         
         const btn = document.createElement('div');
@@ -633,11 +1198,7 @@ def generar_html_final(geojson_data, nombre_cliente, errores):
             </div>
             <span class="filter-btn-right">${{formatArea(areaTotal)}}</span>
         `;
-        btn.onclick = () => {{
-            geoJsonLayer.clearLayers();
-            geoJsonLayer.addData(feats);
-            if(feats.length > 0) map.fitBounds(geoJsonLayer.getBounds());
-        }};
+        btn.onclick = () => mostrar(feats);
         container.appendChild(btn);
     }});
 
@@ -662,12 +1223,13 @@ def generar_html_final(geojson_data, nombre_cliente, errores):
                 div.className = 'result-item';
                 div.innerHTML = `<b>${{m.properties.nombre}}</b> - <small>${{m.properties.ref}}</small>`;
                 div.onclick = () => {{
-                    geoJsonLayer.eachLayer(layer => {{
-                        if(layer.feature.properties.ref === m.properties.ref) {{
-                            map.flyTo(layer.getBounds().getCenter(), 18);
-                            layer.openPopup();
-                        }}
+                    // Los polígonos se crean al terminar el zoom; abrir el popup después
+                    map.once('moveend', () => {{
+                        geoJsonLayer.eachLayer(layer => {{
+                            if(layer.feature.properties.ref === m.properties.ref) layer.openPopup();
+                        }});
                     }});
+                    map.flyTo([m.centro[1], m.centro[0]], ZOOM_COMPLETO);
                     resultsBox.style.display = 'none';
                     searchInput.value = '';
                 }};
@@ -708,40 +1270,30 @@ def main():
     print(f"\n📂 Procesando archivo: {archivo_input}")
     
     try:
-        if archivo_input.endswith('.csv'):
-            df = pd.read_csv(archivo_input)
-        else:
-            df = pd.read_excel(archivo_input)
-            
-        ok, msg = validar_excel(df)
-        if not ok:
-            print(f"❌ Error en Excel: {msg}")
-            return
-            
+        filas = leer_filas(archivo_input)
+    except UnicodeDecodeError:
+        print(f"❌ {archivo_input} no está en UTF-8: guárdalo como 'CSV UTF-8'.")
+        return
+    except ValueError as e:
+        print(f"❌ Error en el archivo: {e}")
+        return
     except Exception as e:
         print(f"❌ Error leyendo archivo: {e}")
         return
 
-    print(f"🚀 Iniciando ({MAX_WORKERS} hilos)... Objetivo: {len(df)} parcelas\n")
+    print(f"🚀 Iniciando ({MAX_WORKERS} hilos)... Objetivo: {len(filas)} parcelas\n")
     
-    features = []
-    errores = []
     completados = 0
-    total = len(df)
+    total = len(filas)
     
-    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        futures = {executor.submit(procesar_fila, i, row): row for i, row in df.iterrows()}
-        
-        for future in as_completed(futures):
-            res, err = future.result()
-            completados += 1
-            sys.stdout.write(f"\r⏳ Progreso: {completados}/{total} ({(completados/total)*100:.1f}%)")
-            sys.stdout.flush()
-            
-            if res:
-                features.append(res)
-            else:
-                errores.append(err)
+    def mostrar_progreso():
+        nonlocal completados
+        completados += 1
+        sys.stdout.write(f"\r⏳ Progreso: {completados}/{total} ({(completados/total)*100:.1f}%)")
+        sys.stdout.flush()
+
+    features, errores = procesar_filas(filas, al_completar=mostrar_progreso,
+                                       plazo_total=PLAZO_TOTAL)
 
     print("\n\n✅ Procesamiento finalizado.")
     
@@ -749,8 +1301,7 @@ def main():
         print("❌ No se pudo recuperar ninguna parcela válida.")
         return
 
-    geojson_collection = {"type": "FeatureCollection", "features": features}
-    html_content = generar_html_final(geojson_collection, cliente, errores)
+    html_content = generar_html_final(features, cliente, errores)
     nombre_salida = f"Mapa_{cliente.replace(' ','_')}.html"
     
     with open(nombre_salida, "w", encoding="utf-8") as f:
@@ -760,6 +1311,9 @@ def main():
     print(f"🎉 ARCHIVO GENERADO: {nombre_salida}")
     print(f"   - Parcelas OK: {len(features)}")
     print(f"   - Errores: {len(errores)}")
+    sin_tiempo = sum(e.motivo == "Plazo total agotado" for e in errores)
+    if sin_tiempo:
+        print(f"   - ⏱️ Sin tiempo (plazo total de {PLAZO_TOTAL}s): {sin_tiempo}")
     print(f"   - ✨ Ahora es 100% RESPONSIVE para móvil")
     print("="*60)
 
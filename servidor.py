@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+SERVIDOR LOCAL DE MAPAS CATASTRALES
+---------------------------------------------------------
+Sirve los mapas de script.py sin pasar por el modo interactivo:
+mantiene parcelas y HTML en memoria, reconstruye el mapa de un cliente
+cuando cambia su hoja de cálculo y responde con ETag/Last-Modified y
+cuerpos precomprimidos en gzip.
+
+Uso: python servidor.py [puerto] [directorio]
+"""
+
+import gzip
+import hashlib
+import sys
+import threading
+import time
+from email.utils import formatdate, parsedate_to_datetime
+from html import escape
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import quote, unquote, urlsplit
+
+from script import (PLAZO_TOTAL, generar_html_final, leer_filas, parcelas_a_geojson,
+                    procesar_filas)
+
+# Segundos tras los que se reintenta, en segundo plano, un mapa con errores
+# transitorios del Catastro (red o plazo agotado)
+REINTENTO_ERRORES = 60
+
+class MapasEnMemoria:
+    """Mantiene geometrías y mapas renderizados en memoria por cliente.
+
+    Cada hoja de cálculo (<cliente>.xlsx / <cliente>.csv) del directorio es un
+    cliente. Su mapa se reconstruye cuando cambia el archivo. Si quedaron
+    errores transitorios, pasados REINTENTO_ERRORES segundos se reconstruye en
+    segundo plano mientras se sigue sirviendo el mapa anterior. Las parcelas ya
+    descargadas se reutilizan, así que sólo se consultan al Catastro las
+    referencias nuevas o fallidas.
+    """
+
+    def __init__(self, directorio="."):
+        self.directorio = Path(directorio)
+        self.geometrias = {}
+        self.salidas = {}
+        self._lock = threading.Lock()
+        self._locks_cliente = {}
+
+    def clientes(self):
+        archivos = sorted(self.directorio.glob('*.xlsx')) + sorted(self.directorio.glob('*.csv'))
+        return sorted({a.stem for a in archivos if not a.name.startswith('~$')})
+
+    def archivo_cliente(self, cliente):
+        if not cliente or Path(cliente).name != cliente:
+            return None
+        for ext in ('.xlsx', '.csv'):
+            archivo = self.directorio / f"{cliente}{ext}"
+            if archivo.is_file():
+                return archivo
+        return None
+
+    def _lock_cliente(self, cliente):
+        with self._lock:
+            return self._locks_cliente.setdefault(cliente, threading.Lock())
+
+    def obtener(self, cliente):
+        archivo = self.archivo_cliente(cliente)
+        if archivo is None:
+            return None
+        with self._lock_cliente(cliente):
+            st = archivo.stat()
+            firma = (st.st_mtime_ns, st.st_size)
+            salida = self.salidas.get(cliente)
+            if salida is None or salida['firma'] != firma:
+                salida = self._construir(cliente, archivo, firma)
+                self.salidas[cliente] = salida
+            elif (salida['transitorios'] and not salida['reintentando']
+                    and time.time() - salida['construido'] >= REINTENTO_ERRORES):
+                salida['reintentando'] = True
+                threading.Thread(target=self._reintentar, args=(cliente, archivo, salida),
+                                 daemon=True).start()
+            return salida
+
+    def _reintentar(self, cliente, archivo, anterior):
+        try:
+            nueva = self._construir(cliente, archivo, anterior['firma'])
+        except Exception as e:
+            print(f"⚠️ {cliente}: reintento fallido ({e})")
+            nueva = None
+        with self._lock_cliente(cliente):
+            # Si el archivo cambió mientras tanto, ya hay una construcción más nueva
+            if self.salidas.get(cliente) is not anterior:
+                return
+            if nueva is None:
+                anterior['construido'] = time.time()
+                anterior['reintentando'] = False
+            else:
+                self.salidas[cliente] = nueva
+
+    def _construir(self, cliente, archivo, firma):
+        t0 = time.perf_counter()
+        filas = leer_filas(archivo)
+        features, errores = procesar_filas(filas, cache=self.geometrias, plazo_total=PLAZO_TOTAL)
+        nombre = cliente.replace('_', ' ')
+        # El cuerpo depende también del Catastro y de la fecha: Last-Modified = construcción
+        construido = time.time()
+        salida = {
+            'firma': firma,
+            'transitorios': sum(e.transitorio for e in errores),
+            'reintentando': False,
+            'construido': construido,
+            'last_modified': formatdate(construido, usegmt=True),
+            'html': cuerpo_http(generar_html_final(features, nombre, errores),
+                                "text/html; charset=utf-8"),
+            'geojson': cuerpo_http(parcelas_a_geojson(features),
+                                   "application/geo+json; charset=utf-8"),
+        }
+        print(f"🔄 {cliente}: {len(features)} parcelas, {len(errores)} errores "
+              f"({time.perf_counter() - t0:.2f}s)")
+        return salida
+
+def cuerpo_http(texto, content_type):
+    datos = texto.encode('utf-8')
+    etag = hashlib.sha1(datos).hexdigest()[:20]
+    return {
+        'content_type': content_type,
+        'datos': datos,
+        'gzip': gzip.compress(datos, compresslevel=9, mtime=0),
+        'etag': f'"{etag}"',
+        'etag_gzip': f'"{etag}-gz"',
+    }
+
+def acepta_gzip(accept_encoding):
+    """True si Accept-Encoding admite gzip con q > 0 (por nombre, x-gzip o '*')."""
+    calidades = {}
+    for parte in accept_encoding.split(','):
+        coding, _, parametros = parte.partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for parametro in parametros.split(';'):
+            clave, _, valor = parametro.partition('=')
+            if clave.strip().lower() == 'q':
+                try:
+                    q = float(valor.strip())
+                except ValueError:
+                    q = 0.0
+        calidades[coding] = q
+    for coding in ('gzip', 'x-gzip', '*'):
+        if coding in calidades:
+            return calidades[coding] > 0
+    return False
+
+class ManejadorMapas(BaseHTTPRequestHandler):
+    # Rutas: /  ·  /mapa/<cliente>  ·  /datos/<cliente>.geojson
+    def do_GET(self):
+        self._responder(enviar_cuerpo=True)
+
+    def do_HEAD(self):
+        self._responder(enviar_cuerpo=False)
+
+    def _responder(self, enviar_cuerpo):
+        mapas = self.server.mapas
+        ruta = unquote(urlsplit(self.path).path)
+        if ruta == '/':
+            return self._indice(mapas, enviar_cuerpo)
+
+        if ruta.startswith('/mapa/'):
+            cliente, tipo = ruta[len('/mapa/'):], 'html'
+        elif ruta.startswith('/datos/') and ruta.endswith('.geojson'):
+            cliente, tipo = ruta[len('/datos/'):-len('.geojson')], 'geojson'
+        else:
+            return self.send_error(404, explain="Ruta no encontrada")
+
+        # Los detalles van sólo en el cuerpo (escapado), nunca en la línea de estado
+        if not cliente.isprintable():
+            return self.send_error(400, explain="Nombre de cliente no válido")
+        try:
+            salida = mapas.obtener(cliente)
+        except UnicodeDecodeError:
+            return self.send_error(422, explain="El archivo no está en UTF-8")
+        except ValueError as e:
+            return self.send_error(422, explain=f"Error en el archivo: {e}")
+        except Exception as e:
+            return self.send_error(500, explain=f"Error leyendo archivo: {e}")
+        if salida is None:
+            return self.send_error(404, explain=f"Cliente no encontrado: {cliente}")
+
+        cuerpo = salida[tipo]
+        usar_gzip = acepta_gzip(self.headers.get('Accept-Encoding', ''))
+        etag = cuerpo['etag_gzip'] if usar_gzip else cuerpo['etag']
+
+        if self._no_modificado(cuerpo, int(salida['construido'])):
+            self.send_response(304)
+            self._cabeceras_cache(etag, salida['last_modified'])
+            self.end_headers()
+            return
+
+        datos = cuerpo['gzip'] if usar_gzip else cuerpo['datos']
+        self.send_response(200)
+        self.send_header("Content-Type", cuerpo['content_type'])
+        self.send_header("Content-Length", str(len(datos)))
+        if usar_gzip:
+            self.send_header("Content-Encoding", "gzip")
+        self._cabeceras_cache(etag, salida['last_modified'])
+        self.end_headers()
+        if enviar_cuerpo:
+            self.wfile.write(datos)
+
+    def _no_modificado(self, cuerpo, construido):
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match is not None:
+            etags = {e.strip().removeprefix('W/') for e in if_none_match.split(',')}
+            return '*' in etags or bool(etags & {cuerpo['etag'], cuerpo['etag_gzip']})
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if if_modified_since:
+            try:
+                return construido <= parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    def _cabeceras_cache(self, etag, last_modified):
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", last_modified)
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Vary", "Accept-Encoding")
+
+    def _indice(self, mapas, enviar_cuerpo):
+        enlaces = "".join(
+            f'<li><a href="/mapa/{quote(c)}">{escape(c)}</a> · '
+            f'<a href="/datos/{quote(c)}.geojson">GeoJSON</a></li>'
+            for c in mapas.clientes()
+        )
+        datos = (f'<!DOCTYPE html><html lang="es"><meta charset="UTF-8">'
+                 f'<title>Mapas de Fincas</title><h1>Mapas de Fincas</h1>'
+                 f'<ul>{enlaces}</ul></html>').encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(datos)))
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        if enviar_cuerpo:
+            self.wfile.write(datos)
+
+def iniciar_servidor(puerto=8000, directorio="."):
+    servidor = ThreadingHTTPServer(("127.0.0.1", puerto), ManejadorMapas)
+    servidor.mapas = MapasEnMemoria(directorio)
+    print("="*60)
+    print(f"   SERVIDOR DE MAPAS | http://127.0.0.1:{puerto}/")
+    print("="*60)
+    try:
+        servidor.serve_forever()
+    except KeyboardInterrupt:
+        print("\n👋 Servidor detenido.")
+    finally:
+        servidor.server_close()
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    puerto = int(args[0]) if args and args[0].isdigit() else 8000
+    directorio = args[1] if len(args) > 1 else "."
+    iniciar_servidor(puerto, directorio)